@@ -1,4 +1,6 @@
 import datajoint as dj
+import functools
+import os
 
 from djutils.templates import SchemaTemplate, required
 
@@ -19,3 +21,27 @@ class PhysicalFile(dj.Manual):
         :return: a string with full path to the root data directory
         """
         return None
+
+
+@functools.lru_cache(maxsize=1)
+def get_root_data_dir() -> str:
+    """
+    Cached lookup of PhysicalFile._get_root_data_dir() - the root data directory is static for the process lifetime
+    :return: a string with full path to the root data directory
+    """
+    return os.fspath(PhysicalFile._get_root_data_dir())
+
+
+def get_relative_path(full_path: str, root_dir: str) -> str:
+    """
+    Convert a full file-path into a posix-style file-path relative to the root data directory
+    :param full_path: full path to a file
+    :param root_dir: full path to the root data directory
+    :return: a string with the file-path relative to `root_dir`
+    :raises ValueError: if `full_path` is not inside `root_dir`
+    """
+    full_path = os.path.normpath(full_path)
+    root_prefix = os.path.join(os.path.normpath(root_dir), '')
+    if not full_path.startswith(root_prefix):
+        raise ValueError('{} is not inside the root data directory {}'.format(full_path, root_dir))
+    return full_path[len(root_prefix):].replace(os.sep, '/')
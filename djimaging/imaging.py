@@ -1,11 +1,10 @@
 import datajoint as dj
 import scanreader
 import numpy as np
-import pathlib
 
 from djutils.templates import required
 
-from .file import schema, PhysicalFile
+from .file import schema, PhysicalFile, get_root_data_dir, get_relative_path
 
 # ===================================== Lookup =====================================
 
@@ -15,7 +14,7 @@ class Channel(dj.Lookup):
     definition = """  # A recording channel
     channel     : tinyint  # 0-based indexing
     """
-    contents = zip(range(5))
+    contents = [(c,) for c in range(5)]
 
 
 # ===================================== ScanImage's scan =====================================
@@ -145,7 +144,7 @@ class ScanInfo(dj.Imported):
                                for plane_idx in range(scan.num_scanning_depths)])
 
         # Insert file(s)
-        root = pathlib.Path(PhysicalFile._get_root_data_dir())
-        scan_files = [pathlib.Path(f).relative_to(root).as_posix() for f in scan_filenames]
+        root_str = get_root_data_dir()
+        scan_files = [get_relative_path(f, root_str) for f in scan_filenames]
         PhysicalFile.insert(zip(scan_files), skip_duplicates=True)
         self.ScanFile.insert([{**key, 'file_path': f} for f in scan_files])
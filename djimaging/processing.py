@@ -1,17 +1,24 @@
 import datajoint as dj
 import scanreader
 import numpy as np
-import pathlib
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Optional
 from uuid import UUID
 
 from .imaging import schema, Scan, ScanInfo, Channel, PhysicalFile
-from .utils import dict_to_hash
+from .file import get_root_data_dir, get_relative_path
+from .utils import dict_to_hash, array_to_hash
 
 from djutils.templates import required, optional
 
 from img_loaders import suite2p
 
+_insert_chunk_size = 1000  # max number of rows shipped per INSERT statement for large part-table inserts
+_mask_pixel_dtype = [('y', 'u2'), ('x', 'u2'), ('w', 'f4')]  # one record per mask pixel, see Segmentation.Mask
+_max_listing_workers = 16  # number of threads listing output directories concurrently in Processing.populate
+
 # ===================================== Lookup =====================================
 
 
@@ -21,7 +28,7 @@ class ProcessingMethod(dj.Lookup):
     processing_method: char(8)
     """
 
-    contents = zip(['suite2p', 'caiman'])
+    contents = [('suite2p',), ('caiman',)]
 
 
 @schema
@@ -55,13 +62,30 @@ class ProcessingParamSet(dj.Lookup):
             cls.insert1(param_dict)
 
 
+def _get_processing_method(table, paramset_idx: int) -> str:
+    """
+    Lookup of the processing method of a ProcessingParamSet.
+    The result is cached in `table._processing_methods` when set - i.e. for the duration of the table's populate() call -
+    avoiding one query per `make` call; outside populate() every lookup queries ProcessingParamSet
+    :param table: the table whose `make` is calling
+    :param paramset_idx: paramset_idx of a ProcessingParamSet
+    :return: the processing method (e.g. "suite2p") of this ProcessingParamSet
+    """
+    cache = getattr(table, '_processing_methods', None)
+    if cache is None:
+        return (ProcessingParamSet & {'paramset_idx': paramset_idx}).fetch1('processing_method')
+    if paramset_idx not in cache:
+        cache[paramset_idx] = (ProcessingParamSet & {'paramset_idx': paramset_idx}).fetch1('processing_method')
+    return cache[paramset_idx]
+
+
 @schema
 class CellCompartment(dj.Lookup):
     definition = """  # cell compartments that can be imaged
     cell_compartment         : char(16)
     """
 
-    contents = zip(['axon', 'soma', 'bouton'])
+    contents = [('axon',), ('soma',), ('bouton',)]
 
 
 @schema
@@ -70,7 +94,7 @@ class MaskType(dj.Lookup):
     mask_type        : varchar(16)
     """
 
-    contents = zip(['soma', 'axon', 'dendrite', 'neuropil', 'artefact', 'unknown'])
+    contents = [('soma',), ('axon',), ('dendrite',), ('neuropil',), ('artefact',), ('unknown',)]
 
 
 # ===================================== Trigger a processing routine =====================================
@@ -83,6 +107,31 @@ class ProcessingTask(dj.Manual):
     """
 
 
+def _list_files(data_dir) -> Optional[list]:
+    """
+    List the files (excluding sub-directories) directly under a directory
+    DirEntry.is_file() uses the entry type cached by scandir, so only symlinks cost an extra stat;
+    symlinks are followed, i.e. symlinked files are listed as files
+    :param data_dir: path to the directory
+    :return: list of full file-paths, or None if the directory does not exist
+    """
+    try:
+        with os.scandir(data_dir) as it:
+            return [e.path for e in it if e.is_file()]
+    except FileNotFoundError:
+        return None
+
+
+def _try_list_files(data_dir) -> Optional[list]:
+    """
+    Same as `_list_files`, but returns None on any OS error (e.g. permission denied, not a directory)
+    """
+    try:
+        return _list_files(data_dir)
+    except OSError:
+        return None
+
+
 @schema
 class Processing(dj.Computed):
     definition = """
@@ -119,44 +168,133 @@ class Processing(dj.Computed):
         """
         return None
 
+    # processing methods with implemented ingestion: method -> (output directory hook, output loader)
+    # (hooks are looked up by name at call time, as they are only bound at schema activation)
+    _output_handlers = {'suite2p': ('_get_suite2p_dir', suite2p.Suite2p)}
+
+    @classmethod
+    def _get_output_dir(cls, key: dict, method: str) -> str:
+        """
+        Retrieve the output directory for a given ProcessingTask, using the directory hook of its processing method
+        :param key: a dictionary of one ProcessingTask
+        :param method: the processing method of this ProcessingTask
+        :return: a string for full path to the resulting output directory
+        """
+        if method not in cls._output_handlers:
+            raise NotImplementedError('Unknown method: {}'.format(method))
+        dir_hook = cls._output_handlers[method][0]
+        data_dir = getattr(cls, dir_hook)(key)
+        if data_dir is None:
+            raise NotImplementedError('{} is not implemented - unable to locate {} outputs'.format(dir_hook, method))
+        return os.fspath(data_dir)
+
     # Run processing only on Scan with ScanInfo inserted
     @property
     def key_source(self):
         return ProcessingTask & ScanInfo
 
+    def populate(self, *restrictions, **kwargs):
+        self._processing_methods = {}  # paramset_idx -> processing method, cached for this populate() call
+        try:
+            self._prefetched_outputs = self._prefetch_outputs(restrictions, **kwargs)
+            return super().populate(*restrictions, **kwargs)
+        finally:
+            self._processing_methods = None
+            self._prefetched_outputs = {}
+
+    def _prefetch_outputs(self, restrictions, keys=None, reserve_jobs=False, order='original', limit=None,
+                          max_calls=None, **kwargs) -> dict:
+        """
+        Resolve and list the output directories of the tasks that a populate() call will process.
+        The directory hooks may query the database, so they are resolved serially; directory listing is I/O-bound
+        (e.g. network drives), so it is done concurrently in a thread pool.
+        This is best-effort: tasks whose directory cannot be resolved are not recorded, and directories that are missing
+        or fail to list are recorded without a listing - `make` then resolves/lists them itself, and any error surfaces
+        in `make`, under populate()'s error handling
+        :param restrictions: restrictions passed to populate()
+        :return: dict of task primary key values -> (output directory, list of full file-paths or None)
+        """
+        if reserve_jobs or (order == 'random' and max_calls is not None):
+            return {}  # the keys processed by this call are not known in advance
+        # same key selection as populate()
+        if keys is None:
+            keys = ((self.key_source & dj.AndList(restrictions)) - self).fetch('KEY', limit=limit)
+        keys = list(keys)
+        if order == 'reverse':
+            keys.reverse()
+        keys = keys[:max_calls]
+
+        task_dirs = {}
+        for key in keys:
+            try:
+                method = _get_processing_method(self, key['paramset_idx'])
+                if method in Processing._output_handlers:
+                    task_dirs[self._task_id(key)] = Processing._get_output_dir(key, method)
+            except (NotImplementedError, dj.DataJointError):
+                continue  # raised again by `make`, where populate() handles it
+
+        with ThreadPoolExecutor(max_workers=_max_listing_workers) as executor:
+            listings = executor.map(_try_list_files, task_dirs.values())
+            return {task_id: (data_dir, file_paths)
+                    for (task_id, data_dir), file_paths in zip(task_dirs.items(), listings)}
+
+    def _task_id(self, key: dict) -> tuple:
+        """
+        :return: the primary key values of the ProcessingTask in `key`, as a hashable tuple
+        """
+        return tuple(key[k] for k in self.primary_key)
+
     def make(self, key):
         # ----
         # trigger suite2p or caiman here
         # ----
 
-        method = (ProcessingParamSet * ProcessingTask & key).fetch1('processing_method')
+        method = _get_processing_method(self, key['paramset_idx'])
+        # output directory and listing prefetched by populate(), if any
+        data_dir, file_paths = getattr(self, '_prefetched_outputs', {}).pop(self._task_id(key), (None, None))
+        if data_dir is None:
+            data_dir = Processing._get_output_dir(key, method)  # raises NotImplementedError for unsupported methods
+
+        if (ScanInfo & key).fetch1('nrois') > 0:
+            raise NotImplementedError(f'{method} ingestion error - Unable to handle ScanImage multi-ROI scanning mode yet')
+
+        # one pass to both check for existence and list the output files
+        # works for Suite2p, maybe something more file-specific for CaImAn
+        if file_paths is None:
+            file_paths = _list_files(data_dir)
+
+        if file_paths is None:
+            start_time = datetime.now()
+            # trigger Suite2p or CaImAn here
+            # wait for completion, then insert with "completion_time", "start_time", no "curation_time"
+            return
+
+        output_loader = Processing._output_handlers[method][1](data_dir)
+        key = {**key, 'proc_completion_time': output_loader.creation_time,
+               'proc_curation_time': output_loader.curation_time}
+        # master and part rows are committed atomically, in the single transaction populate() opens around make()
+        self.insert1(key)
+        # Insert file(s)
+        root_str = get_root_data_dir()
+        files = [get_relative_path(f, root_str) for f in file_paths]
+
+        master_pk = tuple(key[k] for k in self.primary_key)  # ProcessingOutputFile row: (*master_pk, file_path)
+        for i in range(0, len(files), _insert_chunk_size):
+            chunk = files[i:i + _insert_chunk_size]
+            PhysicalFile.insert(zip(chunk), skip_duplicates=True)
+            self.ProcessingOutputFile.insert([(*master_pk, f) for f in chunk], skip_duplicates=True)
 
-        if method == 'suite2p':
-            if (ScanInfo & key).fetch1('nrois') > 0:
-                raise NotImplementedError(f'Suite2p ingestion error - Unable to handle ScanImage multi-ROI scanning mode yet')
 
-            data_dir = pathlib.Path(Processing._get_suite2p_dir(key))
-            if data_dir.exists():
-                s2p_loader = suite2p.Suite2p(data_dir)
-                key = {**key, 'proc_completion_time': s2p_loader.creation_time, 'proc_curation_time': s2p_loader.curation_time}
-                self.insert1(key)
-                # Insert file(s)
-                root = pathlib.Path(PhysicalFile._get_root_data_dir())
-                files = data_dir.glob('*')  # works for Suite2p, maybe something more file-specific for CaImAn
-                files = [pathlib.Path(f).relative_to(root).as_posix() for f in files if f.is_file()]
-
-                PhysicalFile.insert(zip(files), skip_duplicates=True)
-                self.ProcessingOutputFile.insert([{**key, 'file_path': f} for f in files], ignore_extra_fields=True)
-            else:
-                start_time = datetime.now()
-                # trigger Suite2p here
-                # wait for completion, then insert with "completion_time", "start_time", no "curation_time"
-                return
-        else:
-            raise NotImplementedError('Unknown method: {}'.format(method))
+# ===================================== Motion Correction =====================================
 
+@schema
+class ReferenceImage(dj.Manual):
+    definition = """  # motion correction template image, stored once per unique image
+    ref_image_hash               : uuid          # hash of the image content, shape and dtype
+    ---
+    ref_image                    : longblob      # image used as alignment template
+    """
 
-# ===================================== Motion Correction =====================================
 
 @schema
 class MotionCorrection(dj.Imported):
@@ -172,8 +310,8 @@ class MotionCorrection(dj.Imported):
         -> ScanInfo.Field
         ---
         outlier_frames                  : longblob      # mask with true for frames with outlier shifts (already corrected)
-        y_shifts                        : longblob      # (pixels) y motion correction shifts
-        x_shifts                        : longblob      # (pixels) x motion correction shifts
+        y_shifts                        : longblob      # (pixels) y motion correction shifts - float32
+        x_shifts                        : longblob      # (pixels) x motion correction shifts - float32
         y_std                           : float         # (pixels) standard deviation of y shifts
         x_std                           : float         # (pixels) standard deviation of x shifts
         z_drift=null                    : longblob      # z-drift over frame of this Field (plane)
@@ -190,6 +328,7 @@ class MotionCorrection(dj.Imported):
         block_width                     : int           # (px)
         block_count_y                   : int           # number of blocks tiled in the y direction
         block_count_x                   : int           # number of blocks tiled in the x direction
+        block_shifts                    : longblob      # (pixels) y, x shifts of all blocks for every frame - float32, shape (block, 2, frame)
         z_drift=null                    : longblob      # z-drift over frame of this Field (plane)
         """
 
@@ -200,8 +339,6 @@ class MotionCorrection(dj.Imported):
         ---
         block_y                         : longblob      # (y_start, y_end) in pixel of this block
         block_x                         : longblob      # (x_start, x_end) in pixel of this block
-        y_shifts                        : longblob      # (pixels) y motion correction shifts for every frame
-        x_shifts                        : longblob      # (pixels) x motion correction shifts for every frame
         y_std                           : float         # (pixels) standard deviation of y shifts
         x_std                           : float         # (pixels) standard deviation of x shifts
         """
@@ -211,18 +348,25 @@ class MotionCorrection(dj.Imported):
         -> master
         -> ScanInfo.Field
         ---
-        ref_image                    : longblob      # image used as alignment template
+        -> ReferenceImage                            # image used as alignment template
         average_image                : longblob      # mean of registered frames
         correlation_image=null       : longblob      # correlation map (computed during cell detection)
         max_proj_image=null          : longblob      # max of registered frames
         """
 
+    def populate(self, *restrictions, **kwargs):
+        self._processing_methods = {}  # paramset_idx -> processing method, cached for this populate() call
+        try:
+            return super().populate(*restrictions, **kwargs)
+        finally:
+            self._processing_methods = None
+
     def make(self, key):
 
-        method = (ProcessingParamSet * ProcessingTask & key).fetch1('processing_method')
+        method = _get_processing_method(self, key['paramset_idx'])
 
         if method == 'suite2p':
-            data_dir = pathlib.Path(Processing._get_suite2p_dir(key))
+            data_dir = Processing._get_output_dir(key, method)
             s2p_loader = suite2p.Suite2p(data_dir)
 
             field_keys = (ScanInfo.Field & key).fetch('KEY', order_by='field_z')
@@ -235,8 +379,8 @@ class MotionCorrection(dj.Imported):
                 mc_key = (ScanInfo.Field * ProcessingTask & key & field_keys[plane]).fetch1('KEY')
 
                 # -- rigid motion correction --
-                rigid_mc = {'y_shifts': s2p.ops['yoff'],
-                            'x_shifts': s2p.ops['xoff'],
+                rigid_mc = {'y_shifts': np.asarray(s2p.ops['yoff'], dtype=np.float32),
+                            'x_shifts': np.asarray(s2p.ops['xoff'], dtype=np.float32),
                             'y_std': np.nanstd(s2p.ops['yoff']),
                             'x_std': np.nanstd(s2p.ops['xoff']),
                             'outlier_frames': s2p.ops['badframes']}
@@ -245,23 +389,26 @@ class MotionCorrection(dj.Imported):
 
                 # -- non-rigid motion correction --
                 if s2p.ops['nonrigid']:
+                    block_shifts = np.stack([s2p.ops['yoff1'].T, s2p.ops['xoff1'].T], axis=1)  # (block, 2, frame)
                     nonrigid_mc = {'block_height': s2p.ops['block_size'][0],
                                    'block_width': s2p.ops['block_size'][1],
                                    'block_count_y': s2p.ops['nblocks'][0],
                                    'block_count_x': s2p.ops['nblocks'][1],
+                                   'block_shifts': np.ascontiguousarray(block_shifts, dtype=np.float32),
                                    'outlier_frames': s2p.ops['badframes']}
                     nr_blocks = [{**mc_key, 'block_id': b_id,
                                   'block_y': b_y, 'block_x': b_x,
-                                  'y_shifts': bshift_y, 'x_shifts': bshift_x,
                                   'y_std': np.nanstd(bshift_y), 'x_std': np.nanstd(bshift_x)}
-                                 for b_id, (b_y, b_x, bshift_y, bshift_x)
-                                 in enumerate(zip(s2p.ops['xblock'], s2p.ops['yblock'],
-                                                  s2p.ops['yoff1'].T, s2p.ops['xoff1'].T))]
+                                 for b_id, (b_y, b_x, (bshift_y, bshift_x))
+                                 in enumerate(zip(s2p.ops['xblock'], s2p.ops['yblock'], block_shifts))]
                     self.NonRigidMotionCorrection.insert1({**mc_key, **nonrigid_mc})
                     self.Block.insert(nr_blocks)
 
                 # -- summary images --
-                img_dict = {'ref_image': s2p.ref_image,
+                ref_image_hash = UUID(array_to_hash(s2p.ref_image))
+                ReferenceImage.insert1({'ref_image_hash': ref_image_hash, 'ref_image': s2p.ref_image},
+                                       skip_duplicates=True)
+                img_dict = {'ref_image_hash': ref_image_hash,
                             'average_image': s2p.mean_image,
                             'correlation_image': s2p.correlation_map,
                             'max_proj_image': s2p.max_proj_image}
@@ -289,16 +436,21 @@ class Segmentation(dj.Computed):
         mask_npix                : int           # number of pixels in ROIs
         mask_center_x            : int           # center x coordinate in pixels
         mask_center_y            : int           # center y coordinate in pixels
-        mask_xpix                : longblob      # x coordinates in pixels
-        mask_ypix                : longblob      # y coordinates in pixels        
-        mask_weights             : longblob      # weights of the mask at the indices above in column major (Fortran) order
+        mask_pixels              : longblob      # structured array of the mask pixels - y, x coordinates (uint16) and weights w (float32), in column major (Fortran) order
         """
 
+    def populate(self, *restrictions, **kwargs):
+        self._processing_methods = {}  # paramset_idx -> processing method, cached for this populate() call
+        try:
+            return super().populate(*restrictions, **kwargs)
+        finally:
+            self._processing_methods = None
+
     def make(self, key):
-        method = (ProcessingParamSet * ProcessingTask & key).fetch1('processing_method')
+        method = _get_processing_method(self, key['paramset_idx'])
 
         if method == 'suite2p':
-            data_dir = pathlib.Path(Processing._get_suite2p_dir(key))
+            data_dir = Processing._get_output_dir(key, method)
             s2p_loader = suite2p.Suite2p(data_dir)
 
             field_keys = (ScanInfo.Field & key).fetch('KEY', order_by='field_z')
@@ -313,9 +465,8 @@ class Segmentation(dj.Computed):
                                   'mask_npix': mask_stat['npix'],
                                   'mask_center_x':  mask_stat['med'][1],
                                   'mask_center_y':  mask_stat['med'][0],
-                                  'mask_xpix':  mask_stat['xpix'],
-                                  'mask_ypix':  mask_stat['ypix'],
-                                  'mask_weights':  mask_stat['lam']})
+                                  'mask_pixels': np.rec.fromarrays([mask_stat['ypix'], mask_stat['xpix'], mask_stat['lam']],
+                                                                   dtype=_mask_pixel_dtype)})
                     if is_cell:
                         cells.append({**seg_key, 'mask_classification_method': 'suite2p_default_classifier',
                                       'mask': mask_idx + mask_count, 'mask_type': 'soma', 'confidence': cell_prob})
@@ -336,7 +487,7 @@ class MaskClassificationMethod(dj.Lookup):
     mask_classification_method: varchar(32)
     """
 
-    contents = zip(['suite2p_default_classifier'])
+    contents = [('suite2p_default_classifier',)]
 
 
 @schema
@@ -375,11 +526,18 @@ class Fluorescence(dj.Computed):
         neuropil_fluorescence=null  : longblob  # Neuropil fluorescence trace
         """
 
+    def populate(self, *restrictions, **kwargs):
+        self._processing_methods = {}  # paramset_idx -> processing method, cached for this populate() call
+        try:
+            return super().populate(*restrictions, **kwargs)
+        finally:
+            self._processing_methods = None
+
     def make(self, key):
-        method = (ProcessingParamSet * ProcessingTask & key).fetch1('processing_method')
+        method = _get_processing_method(self, key['paramset_idx'])
 
         if method == 'suite2p':
-            data_dir = pathlib.Path(Processing._get_suite2p_dir(key))
+            data_dir = Processing._get_output_dir(key, method)
             s2p_loader = suite2p.Suite2p(data_dir)
 
             self.insert1(key)
@@ -411,7 +569,7 @@ class ActivityExtractionMethod(dj.Lookup):
     extraction_method: varchar(32)
     """
 
-    contents = zip(['suite2p_deconvolution', 'caiman_deconvolution', 'caiman_dff'])
+    contents = [('suite2p_deconvolution',), ('caiman_deconvolution',), ('caiman_dff',)]
 
 
 @schema
@@ -429,13 +587,20 @@ class Activity(dj.Computed):
         activity_trace: longblob  # 
         """
 
+    def populate(self, *restrictions, **kwargs):
+        self._processing_methods = {}  # paramset_idx -> processing method, cached for this populate() call
+        try:
+            return super().populate(*restrictions, **kwargs)
+        finally:
+            self._processing_methods = None
+
     def make(self, key):
 
-        method = (ProcessingParamSet * ProcessingTask & key).fetch1('processing_method')
+        method = _get_processing_method(self, key['paramset_idx'])
 
         if method == 'suite2p':
             if key['extraction_method'] == 'suite2p_deconvolution':
-                data_dir = pathlib.Path(Processing._get_suite2p_dir(key))
+                data_dir = Processing._get_output_dir(key, method)
                 s2p_loader = suite2p.Suite2p(data_dir)
 
                 self.insert1(key)
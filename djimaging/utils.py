@@ -1,4 +1,5 @@
 import hashlib
+import numpy as np
 
 
 def dict_to_hash(key):
@@ -10,3 +11,15 @@ def dict_to_hash(key):
         hashed.update(str(k).encode())
         hashed.update(str(v).encode())
     return hashed.hexdigest()
+
+
+def array_to_hash(arr):
+    """
+    Given a numpy array `arr`, returns a hash string of its content, shape and dtype
+    """
+    arr = np.ascontiguousarray(arr)
+    hashed = hashlib.md5()
+    hashed.update(str(arr.dtype).encode())
+    hashed.update(str(arr.shape).encode())
+    hashed.update(arr.tobytes())
+    return hashed.hexdigest()